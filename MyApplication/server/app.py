@@ -1,7 +1,8 @@
 import os
 from dotenv import load_dotenv
 from flask import Flask
-from app.extensions import mongo, bcrypt, login_manager
+from app.extensions import mongo, bcrypt, login_manager, admission, router, aggregation_writer
+from app.db import client_options
 
 load_dotenv()
 
@@ -12,12 +13,53 @@ def create_app():
     mongo_host = os.getenv('MONGO_HOST', 'localhost')
     mongo_port = os.getenv('MONGO_PORT', '27017')
     mongo_db = os.getenv('MONGO_DB', 'global')
-    mongo_uri = f"mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:{mongo_port}/{mongo_db}?authSource=admin&retryWrites=true&w=majority"
+    mongo_uri = f"mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:{mongo_port}/{mongo_db}?authSource=admin"
     print(f"Mongo URI: {mongo_uri}")
     app.config['MONGO_URI'] = mongo_uri
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
-    mongo.init_app(app)
+    # Mongo client settings (see app/db.py); empty values keep the driver defaults
+    def optional_int(name):
+        value = os.getenv(name)
+        return int(value) if value else None
+
+    app.config['MONGO_MAX_POOL_SIZE'] = optional_int('MONGO_MAX_POOL_SIZE')
+    app.config['MONGO_MIN_POOL_SIZE'] = optional_int('MONGO_MIN_POOL_SIZE')
+    app.config['MONGO_MAX_IDLE_TIME_MS'] = optional_int('MONGO_MAX_IDLE_TIME_MS')
+    app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS')
+    app.config['MONGO_CONNECT_TIMEOUT_MS'] = optional_int('MONGO_CONNECT_TIMEOUT_MS')
+    app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = optional_int('MONGO_SERVER_SELECTION_TIMEOUT_MS')
+    app.config['MONGO_SOCKET_TIMEOUT_MS'] = optional_int('MONGO_SOCKET_TIMEOUT_MS')
+    app.config['MONGO_COMPRESSORS'] = os.getenv('MONGO_COMPRESSORS', '')
+    app.config['MONGO_WRITE_CONCERN'] = os.getenv('MONGO_WRITE_CONCERN', 'majority')
+    # Read routing: heatmap, profile and leaderboard reads; relaxed write concern for raw inserts
+    app.config['MONGO_ANALYTICS_READ_PREFERENCE'] = os.getenv('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+    app.config['MONGO_MAX_STALENESS_S'] = int(os.getenv('MONGO_MAX_STALENESS_S', '90'))
+    app.config['MONGO_RAW_INSERT_W'] = os.getenv('MONGO_RAW_INSERT_W', '1')
+
+    # Admission control (see app/admission.py)
+    app.config['ADMISSION_USER_RATE'] = float(os.getenv('ADMISSION_USER_RATE', '1'))
+    app.config['ADMISSION_USER_BURST'] = int(os.getenv('ADMISSION_USER_BURST', '10'))
+    app.config['ADMISSION_INGEST_CONCURRENCY'] = int(os.getenv('ADMISSION_INGEST_CONCURRENCY', '4'))
+    app.config['ADMISSION_READ_CONCURRENCY'] = int(os.getenv('ADMISSION_READ_CONCURRENCY', '12'))
+    app.config['ADMISSION_MONGO_LATENCY_MS'] = float(os.getenv('ADMISSION_MONGO_LATENCY_MS', '200'))
+    app.config['ADMISSION_BACKEND'] = os.getenv('ADMISSION_BACKEND', 'memory')
+    app.config['ADMISSION_SLOT_LEASE_S'] = int(os.getenv('ADMISSION_SLOT_LEASE_S', '60'))
+    app.config['ADMISSION_MONGO_TIMEOUT_MS'] = int(os.getenv('ADMISSION_MONGO_TIMEOUT_MS', '50'))
+
+    # Hot-cell write coalescing and sharding (see app/aggregation.py)
+    app.config['AGGREGATION_COALESCE_MS'] = int(os.getenv('AGGREGATION_COALESCE_MS', '0'))
+    app.config['AGGREGATION_MAX_PENDING'] = int(os.getenv('AGGREGATION_MAX_PENDING', '1000'))
+    app.config['AGGREGATION_HOT_SHARDS'] = int(os.getenv('AGGREGATION_HOT_SHARDS', '1'))
+    app.config['AGGREGATION_HOT_THRESHOLD'] = int(os.getenv('AGGREGATION_HOT_THRESHOLD', '50'))
+
+    # Ops token required by GET /stats; empty disables the endpoint
+    app.config['STATS_TOKEN'] = os.getenv('STATS_TOKEN', '')
+
+    admission.init_app(app)
+    aggregation_writer.init_app(app)
+    router.init_app(app)
+    mongo.init_app(app, event_listeners=[admission.latency, router.pool_stats], **client_options(app.config))
     bcrypt.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
@@ -0,0 +1,283 @@
+import math
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import jsonify
+from flask_login import current_user
+import pymongo
+from pymongo import ReturnDocument, WriteConcern
+from pymongo.monitoring import CommandListener
+
+INGEST = 'ingest'
+READ = 'read'
+
+# Commands whose latency reflects the load of the ingest path: queries such as
+# $geoNear or the coalesced bulk upserts are slow by nature and are not sampled
+LATENCY_COMMANDS = frozenset({'insert', 'update', 'delete', 'findAndModify', 'ping'})
+
+
+class InProcessBackend:
+    """
+    Per-user token buckets and concurrency slots kept in the memory of the
+    current worker: the concurrency limits apply to each worker separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, last refill time)
+        self._slots = {}    # kind -> semaphore
+
+    def take(self, key, rate, burst):
+        """
+        Takes one token from the bucket of a key.
+
+        :param key: str, the bucket key (the username).
+        :param rate: float, tokens added per second.
+        :param burst: int, maximum number of tokens in the bucket.
+        :return: (bool, float), whether the call is allowed and the seconds to wait otherwise.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def acquire(self, kind, limit):
+        """
+        Takes one of the concurrency slots of a path.
+
+        :param kind: str, INGEST or READ.
+        :param limit: int, the number of slots.
+        :return: a slot to pass to release(), or None if every slot is taken.
+        """
+        with self._lock:
+            if kind not in self._slots:
+                self._slots[kind] = threading.BoundedSemaphore(limit)
+            slots = self._slots[kind]
+        return kind if slots.acquire(blocking=False) else None
+
+    def release(self, kind, slot):
+        self._slots[kind].release()
+
+
+class MongoBackend:
+    """
+    Per-user token buckets and ingest slots shared by every worker, stored
+    in the 'rate_limits' collection: the ingest limits apply to the whole
+    deployment. Each operation is a single atomic pipeline update, written
+    with w=1 and bounded by timeout_ms.
+
+    Read slots stay in the memory of each worker, as a shared read slot
+    would cost two writes on one hot document for every map request.
+
+    A slot is a lease that expires after lease_s, so the slots held by a
+    killed worker are given back. If Mongo cannot be reached in time, calls are admitted.
+    """
+
+    def __init__(self, lease_s=60, timeout_ms=50):
+        self.lease_s = lease_s
+        self.timeout_s = timeout_ms / 1000
+        self._local = InProcessBackend()
+
+    def _collection(self):
+        from app.extensions import mongo
+        # Losing a token or a lease on failover is harmless, waiting for a majority is not
+        return mongo.db.get_collection('rate_limits', write_concern=WriteConcern(w=1))
+
+    def take(self, key, rate, burst):
+        now = datetime.now(timezone.utc)
+        elapsed_s = {'$divide': [{'$subtract': [now, {'$ifNull': ['$ts', now]}]}, 1000]}
+        try:
+            with pymongo.timeout(self.timeout_s):
+                doc = self._collection().find_one_and_update(
+                    {'_id': key},
+                    [
+                        {'$set': {
+                            'tokens': {'$min': [burst, {'$add': [{'$ifNull': ['$tokens', burst]}, {'$multiply': [elapsed_s, rate]}]}]},
+                            'ts': now
+                        }},
+                        {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+                        {'$set': {'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']}}}
+                    ],
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+        except Exception as e:
+            print(f"Error taking rate limit token for {key}: {e}")
+            return True, 0
+        if doc['allowed']:
+            return True, 0
+        return False, (1 - doc['tokens']) / rate
+
+    def acquire(self, kind, limit):
+        if kind == READ:
+            return self._local.acquire(kind, limit)
+        now = datetime.now(timezone.utc)
+        slot = uuid.uuid4().hex
+        try:
+            with pymongo.timeout(self.timeout_s):
+                doc = self._collection().find_one_and_update(
+                    {'_id': f'slots:{kind}'},
+                    [
+                        # Drop the expired leases, then take one if there is room
+                        {'$set': {'holders': {'$filter': {
+                            'input': {'$ifNull': ['$holders', []]},
+                            'cond': {'$gt': ['$$this.expires', now]}
+                        }}}},
+                        {'$set': {'allowed': {'$lt': [{'$size': '$holders'}, limit]}}},
+                        {'$set': {'holders': {'$cond': [
+                            '$allowed',
+                            {'$concatArrays': ['$holders', [{'id': slot, 'expires': now + timedelta(seconds=self.lease_s)}]]},
+                            '$holders'
+                        ]}}}
+                    ],
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+        except Exception as e:
+            print(f"Error acquiring {kind} slot: {e}")
+            return ''
+        return slot if doc['allowed'] else None
+
+    def release(self, kind, slot):
+        if kind == READ:
+            self._local.release(kind, slot)
+            return
+        if not slot:
+            return
+        try:
+            with pymongo.timeout(self.timeout_s):
+                self._collection().update_one({'_id': f'slots:{kind}'}, {'$pull': {'holders': {'id': slot}}})
+        except Exception as e:
+            # The lease expires on its own after lease_s
+            print(f"Error releasing {kind} slot: {e}")
+
+
+class MongoLatencyTracker(CommandListener):
+    """
+    PyMongo command listener keeping an exponentially weighted moving average
+    of the latency of the LATENCY_COMMANDS sent to the server.
+    """
+
+    def __init__(self, alpha=0.2, stale_after_s=5):
+        self.alpha = alpha
+        self.stale_after_s = stale_after_s
+        self._ewma_ms = 0.0
+        self._last_sample = 0.0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in LATENCY_COMMANDS:
+            self._record(event.duration_micros / 1000)
+
+    def failed(self, event):
+        if event.command_name in LATENCY_COMMANDS:
+            self._record(event.duration_micros / 1000)
+
+    def _record(self, latency_ms):
+        # A lost update under concurrency only skews the average slightly
+        self._ewma_ms += self.alpha * (latency_ms - self._ewma_ms)
+        self._last_sample = time.monotonic()
+
+    @property
+    def latency_ms(self):
+        """
+        :return: float, the average latency, or 0 if there were no recent commands.
+        """
+        if time.monotonic() - self._last_sample > self.stale_after_s:
+            return 0.0
+        return self._ewma_ms
+
+
+class AdmissionController:
+    """
+    Admission control for the ingest and read paths.
+
+    - Ingest calls are limited per user by a token bucket (429 when empty).
+    - Each path has a concurrency limit (503 when full), per worker with the
+      in-process backend; with ADMISSION_BACKEND=mongo the ingest limit is
+      shared across workers, the read limit stays per worker.
+    - When the Mongo write latency crosses a threshold, ingest is shed (503) first,
+      so map readers keep being served.
+    Shed calls carry a Retry-After header.
+    """
+
+    def __init__(self, app=None):
+        self.latency = MongoLatencyTracker()
+        self.backend = InProcessBackend()
+        self.user_rate = 1.0
+        self.user_burst = 10
+        self.latency_threshold_ms = 200.0
+        self.retry_after_s = 1
+        self.concurrency = {INGEST: 4, READ: 12}
+        self.shed = {INGEST: 0, READ: 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_USER_RATE', 1.0)
+        app.config.setdefault('ADMISSION_USER_BURST', 10)
+        app.config.setdefault('ADMISSION_INGEST_CONCURRENCY', 4)
+        app.config.setdefault('ADMISSION_READ_CONCURRENCY', 12)
+        app.config.setdefault('ADMISSION_MONGO_LATENCY_MS', 200.0)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        app.config.setdefault('ADMISSION_BACKEND', 'memory')
+        app.config.setdefault('ADMISSION_SLOT_LEASE_S', 60)
+        app.config.setdefault('ADMISSION_MONGO_TIMEOUT_MS', 50)
+
+        self.user_rate = float(app.config['ADMISSION_USER_RATE'])
+        self.user_burst = int(app.config['ADMISSION_USER_BURST'])
+        self.latency_threshold_ms = float(app.config['ADMISSION_MONGO_LATENCY_MS'])
+        self.retry_after_s = int(app.config['ADMISSION_RETRY_AFTER'])
+        self.concurrency = {
+            INGEST: int(app.config['ADMISSION_INGEST_CONCURRENCY']),
+            READ: int(app.config['ADMISSION_READ_CONCURRENCY']),
+        }
+        if app.config['ADMISSION_BACKEND'] == 'mongo':
+            self.backend = MongoBackend(int(app.config['ADMISSION_SLOT_LEASE_S']), int(app.config['ADMISSION_MONGO_TIMEOUT_MS']))
+        else:
+            self.backend = InProcessBackend()
+
+    def _reject(self, kind, status, message, retry_after_s):
+        self.shed[kind] += 1
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after_s)))
+        return response
+
+    def limit(self, kind):
+        """
+        Decorator applying admission control to a route. Must be placed
+        after @login_required, as ingest buckets are keyed by the current user.
+
+        :param kind: str, INGEST or READ.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if kind == INGEST and self.latency.latency_ms > self.latency_threshold_ms:
+                    return self._reject(kind, 503, 'Server overloaded, retry later', self.retry_after_s)
+
+                # The slot is checked first, so a busy server does not use up the user's tokens
+                slot = self.backend.acquire(kind, self.concurrency[kind])
+                if slot is None:
+                    return self._reject(kind, 503, 'Server busy, retry later', self.retry_after_s)
+                try:
+                    if kind == INGEST:
+                        allowed, wait_s = self.backend.take(current_user.username, self.user_rate, self.user_burst)
+                        if not allowed:
+                            return self._reject(kind, 429, 'Too many measurements, slow down', wait_s)
+                    return view(*args, **kwargs)
+                finally:
+                    self.backend.release(kind, slot)
+            return wrapper
+        return decorator
@@ -0,0 +1,239 @@
+import atexit
+import os
+import random
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, ConnectionFailure, DuplicateKeyError, NetworkTimeout, OperationFailure, ServerSelectionTimeoutError, WriteConcernError
+
+DUPLICATE_KEY = 11000
+
+
+def aggregated_filter(geohash, time_bucket, shard=0):
+    """
+    Filter of one aggregated_measurements document. Shard 0 is the regular
+    document (no 'shard' field); hot cells may also have documents for shards 1..N-1.
+    """
+    query = {'geohash': geohash, 'time_bucket': time_bucket}
+    query['shard'] = shard if shard else {'$exists': False}
+    return query
+
+
+def _upsert(geohash, time_bucket, shard, sum_noise, count, center):
+    """Returns the (filter, update) pair of one increment."""
+    return (
+        aggregated_filter(geohash, time_bucket, shard),
+        {
+            '$inc': { 'sum_noise': sum_noise, 'count': count },
+            # Save the cell center on the first insertion
+            '$setOnInsert': { 'center': center }
+        }
+    )
+
+
+class AggregationWriter:
+    """
+    Writes the sum_noise/count increments of aggregated_measurements.
+
+    - With AGGREGATION_COALESCE_MS = 0 every measurement is upserted right away,
+      and errors are raised to the caller (process_measurement rolls back).
+    - Otherwise increments of the same {geohash, time_bucket} cell are summed
+      in memory and flushed as one unordered bulk upsert every window. Up to one
+      window of increments is lost if the worker is killed.
+    - With AGGREGATION_HOT_SHARDS > 1, a cell receiving at least
+      AGGREGATION_HOT_THRESHOLD measurements in a window is spread over that
+      many sub-bucket documents; the read pipelines group by geohash and sum
+      them back together.
+    Upserts that race on the unique index are retried once, as the retry then
+    matches the document inserted by the other writer. A flushed increment is
+    only queued again when it is known not to have been applied; when the
+    outcome is unknown (e.g. the connection dropped mid-bulk) it is dropped and
+    counted, as writing it twice would double the cell's sum and count. Only
+    network errors leave the outcome unknown: on any other error the
+    increments are queued again and the error is raised.
+    """
+
+    def __init__(self, app=None):
+        self.coalesce_s = 0
+        self.shards = 1
+        self.hot_threshold = 50
+        self.max_pending = 1000
+        self.stats = {'measurements': 0, 'upserts': 0, 'flushes': 0, 'retries': 0, 'errors': 0, 'dropped': 0}
+        self._lock = threading.Lock()
+        self._pending = {}  # (geohash, time_bucket) -> [sum_noise, count, center]
+        self._hits = {}     # (geohash, time_bucket) -> measurements in the current window
+        self._window_start = time.monotonic()
+        self._wakeup = threading.Event()
+        self._flusher_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AGGREGATION_COALESCE_MS', 0)
+        app.config.setdefault('AGGREGATION_MAX_PENDING', 1000)
+        app.config.setdefault('AGGREGATION_HOT_SHARDS', 1)
+        app.config.setdefault('AGGREGATION_HOT_THRESHOLD', 50)
+
+        self.coalesce_s = int(app.config['AGGREGATION_COALESCE_MS']) / 1000
+        self.max_pending = int(app.config['AGGREGATION_MAX_PENDING'])
+        self.shards = max(1, int(app.config['AGGREGATION_HOT_SHARDS']))
+        self.hot_threshold = int(app.config['AGGREGATION_HOT_THRESHOLD'])
+        if self.coalesce_s:
+            atexit.register(self.flush)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def _shard(self, hits):
+        if self.shards > 1 and hits >= self.hot_threshold:
+            return random.randrange(self.shards)
+        return 0
+
+    def add(self, geohash, time_bucket, noise_level, center):
+        """
+        Adds one measurement to its aggregated cell.
+
+        :param geohash: str, the cell geohash.
+        :param time_bucket: datetime, the start of the hour.
+        :param noise_level: float, the measured noise level.
+        :param center: dict, GeoJSON point stored when the cell is created.
+        """
+        key = (geohash, time_bucket)
+        if not self.coalesce_s:
+            with self._lock:
+                now = time.monotonic()
+                if now - self._window_start > 1:
+                    self._hits = {}
+                    self._window_start = now
+                hits = self._hits[key] = self._hits.get(key, 0) + 1
+                self.stats['measurements'] += 1
+            self._write([_upsert(geohash, time_bucket, self._shard(hits), noise_level, 1, center)])
+            return
+
+        self._ensure_flusher()
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [noise_level, 1, center]
+            else:
+                entry[0] += noise_level
+                entry[1] += 1
+            self.stats['measurements'] += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes every pending increment as one bulk upsert. Increments known
+        not to have been written are merged back into the pending ones and
+        retried with the next flush.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        upserts = [
+            _upsert(geohash, time_bucket, self._shard(count), sum_noise, count, center)
+            for (geohash, time_bucket), (sum_noise, count, center) in pending.items()
+        ]
+        try:
+            failed = self._write(upserts)
+            self._count('flushes')
+        except WriteConcernError as e:
+            # Applied on the primary, only the acknowledgement is missing
+            print(f"Write concern error flushing aggregated measurements: {e}")
+            failed = []
+        except ServerSelectionTimeoutError as e:
+            # No server was selected, so nothing was sent
+            print(f"Error flushing aggregated measurements, will retry: {e}")
+            failed = upserts
+        except OperationFailure as e:
+            # Only raised by the single upsert: the server rejected it
+            print(f"Error flushing aggregated measurements, will retry: {e}")
+            failed = upserts
+        except (AutoReconnect, NetworkTimeout, ConnectionFailure) as e:
+            # The connection failed mid-write: some upserts may have been applied
+            dropped = sum(update['$inc']['count'] for _, update in upserts)
+            print(f"Error flushing aggregated measurements, dropping {dropped} measurements of unknown outcome: {e}")
+            self._count('errors')
+            self._count('dropped', dropped)
+            return
+        except Exception:
+            # Not a network error, so nothing was written: keep the increments and let it surface
+            self._requeue(upserts)
+            raise
+        if not failed:
+            return
+
+        print(f"Error flushing {len(failed)} aggregated measurements, will retry")
+        self._requeue(failed)
+
+    def _requeue(self, failed):
+        """Merges increments that were not written back into the pending ones."""
+        with self._lock:
+            self.stats['errors'] += 1
+            for query, update in failed:
+                key = (query['geohash'], query['time_bucket'])
+                entry = self._pending.setdefault(key, [0, 0, update['$setOnInsert']['center']])
+                entry[0] += update['$inc']['sum_noise']
+                entry[1] += update['$inc']['count']
+
+    def _bulk(self, collection, upserts):
+        """
+        :return: (list, list), the upserts that hit a duplicate key and the ones that failed otherwise.
+        Write concern errors are not failures: those writes were applied.
+        """
+        try:
+            collection.bulk_write([UpdateOne(query, update, upsert=True) for query, update in upserts], ordered=False)
+            return [], []
+        except BulkWriteError as e:
+            duplicate, failed = [], []
+            for error in e.details['writeErrors']:
+                (duplicate if error['code'] == DUPLICATE_KEY else failed).append(upserts[error['index']])
+            return duplicate, failed
+
+    def _write(self, upserts):
+        """
+        A single upsert raises on failure; a bulk returns the upserts that failed.
+        """
+        from app.extensions import router
+        collection = router.collection('aggregated_measurements')
+        if len(upserts) == 1:
+            query, update = upserts[0]
+            try:
+                collection.update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                self._count('retries')
+                collection.update_one(query, update, upsert=True)
+            self._count('upserts')
+            return []
+
+        duplicate, failed = self._bulk(collection, upserts)
+        if duplicate:
+            self._count('retries', len(duplicate))
+            duplicate, failed_retry = self._bulk(collection, duplicate)
+            failed += duplicate + failed_retry
+        self._count('upserts', len(upserts) - len(failed))
+        return failed
+
+    def _ensure_flusher(self):
+        # Started lazily, and again after a fork, as threads do not survive fork()
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._run, name='aggregation-flusher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.coalesce_s)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing aggregated measurements, will retry: {e}")
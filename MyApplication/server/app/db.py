@@ -0,0 +1,175 @@
+import threading
+
+from pymongo import ReadPreference, WriteConcern
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+# Routes used by the repositories. Each one maps to its own read preference
+# and write concern, so map/profile/leaderboard reads can be served by
+# secondaries while writes keep the durability they need.
+ROUTE_DEFAULT = 'default'
+ROUTE_HEATMAP = 'heatmap'
+ROUTE_PROFILE = 'profile'
+ROUTE_LEADERBOARD = 'leaderboard'
+ROUTE_RAW_INSERT = 'raw_insert'
+ANALYTICS_ROUTES = (ROUTE_HEATMAP, ROUTE_PROFILE, ROUTE_LEADERBOARD)
+
+
+def _w(value):
+    # "1" from the environment means one node, "majority" is a mode name
+    return int(value) if str(value).isdigit() else value
+
+
+def client_options(config):
+    """
+    Builds the MongoClient keyword arguments from the Flask config.
+
+    :param config: the Flask config, with the MONGO_* keys set by create_app.
+    :return: dict of MongoClient options.
+    """
+    options = {
+        'maxPoolSize': config['MONGO_MAX_POOL_SIZE'],
+        'minPoolSize': config['MONGO_MIN_POOL_SIZE'],
+        'maxIdleTimeMS': config['MONGO_MAX_IDLE_TIME_MS'],
+        'waitQueueTimeoutMS': config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+        'connectTimeoutMS': config['MONGO_CONNECT_TIMEOUT_MS'],
+        'serverSelectionTimeoutMS': config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        'socketTimeoutMS': config['MONGO_SOCKET_TIMEOUT_MS'],
+        'retryWrites': True,
+        'w': _w(config['MONGO_WRITE_CONCERN']),
+    }
+    if config['MONGO_COMPRESSORS']:
+        options['compressors'] = config['MONGO_COMPRESSORS']
+    # None means "use the driver default"
+    return {key: value for key, value in options.items() if value is not None}
+
+
+class PoolStats(ConnectionPoolListener):
+    """
+    Connection pool listener keeping counters per server, for monitoring.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def _server(self, address):
+        key = f'{address[0]}:{address[1]}'
+        if key not in self._servers:
+            self._servers[key] = {
+                'open': 0,
+                'in_use': 0,
+                'checkouts': 0,
+                'checkout_failures': 0,
+                'checkout_wait_ms_total': 0.0,
+                'checkout_wait_ms_max': 0.0,
+                'cleared': 0,
+            }
+        return self._servers[key]
+
+    def snapshot(self):
+        with self._lock:
+            return {address: dict(stats) for address, stats in self._servers.items()}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._server(event.address)['cleared'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._server(event.address)['open'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._server(event.address)['open'] -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._server(event.address)['checkout_failures'] += 1
+
+    def connection_checked_out(self, event):
+        wait_ms = (getattr(event, 'duration', None) or 0) * 1000
+        with self._lock:
+            stats = self._server(event.address)
+            stats['in_use'] += 1
+            stats['checkouts'] += 1
+            stats['checkout_wait_ms_total'] += wait_ms
+            stats['checkout_wait_ms_max'] = max(stats['checkout_wait_ms_max'], wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._server(event.address)['in_use'] -= 1
+
+
+class MongoRouter:
+    """
+    Hands out collections bound to the read preference and write concern of
+    a route, and counts how many operations each route served.
+    """
+
+    def __init__(self, app=None):
+        self.pool_stats = PoolStats()
+        self.routes = {}
+        self.calls = {}
+        self.max_staleness_s = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+        app.config.setdefault('MONGO_MAX_STALENESS_S', 90)
+        app.config.setdefault('MONGO_RAW_INSERT_W', 1)
+
+        mode = read_pref_mode_from_name(app.config['MONGO_ANALYTICS_READ_PREFERENCE'])
+        # maxStalenessSeconds is not allowed with the primary mode
+        max_staleness = app.config['MONGO_MAX_STALENESS_S'] if mode != ReadPreference.PRIMARY.mode else -1
+        analytics = make_read_preference(mode, None, max_staleness=max_staleness)
+        # How far behind the primary an analytics read may be
+        self.max_staleness_s = max(max_staleness, 0)
+
+        self.routes = {ROUTE_DEFAULT: {}, ROUTE_RAW_INSERT: {'write_concern': WriteConcern(w=_w(app.config['MONGO_RAW_INSERT_W']))}}
+        for route in ANALYTICS_ROUTES:
+            self.routes[route] = {'read_preference': analytics}
+        self.calls = {route: 0 for route in self.routes}
+
+    def collection(self, name, route=ROUTE_DEFAULT):
+        """
+        :param name: str, the collection name.
+        :param route: str, one of the ROUTE_* constants.
+        :return: the collection with the options of the route applied.
+        """
+        from app.extensions import mongo
+        with self._lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+        return mongo.db.get_collection(name, **self.routes.get(route, {}))
+
+    def stats(self):
+        """
+        :return: dict with the routing table, the calls per route and the pool counters.
+        """
+        routes = {}
+        for route, options in self.routes.items():
+            read_preference = options.get('read_preference')
+            write_concern = options.get('write_concern')
+            routes[route] = {
+                'read_preference': read_preference.document if read_preference else 'client default',
+                'write_concern': write_concern.document if write_concern else 'client default',
+                'calls': self.calls.get(route, 0),
+            }
+        return {'routes': routes, 'pools': self.pool_stats.snapshot()}
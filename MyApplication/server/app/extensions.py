@@ -1,7 +1,13 @@
 from flask_pymongo import PyMongo
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
+from app.admission import AdmissionController
+from app.db import MongoRouter
+from app.aggregation import AggregationWriter
 
 mongo = PyMongo()
 bcrypt = Bcrypt()
 login_manager = LoginManager()
+admission = AdmissionController()
+router = MongoRouter()
+aggregation_writer = AggregationWriter()
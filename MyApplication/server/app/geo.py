@@ -0,0 +1,57 @@
+import gc
+import importlib
+
+# Modules that are slow to import and only hold read-only data once loaded.
+# Importing them in the master process lets forked workers share their pages.
+PRELOAD_MODULES = (
+    'flask',
+    'flask_login',
+    'flask_bcrypt',
+    'flask_pymongo',
+    'pymongo',
+    'bson',
+    'geohash2',
+    'reverse_geocode',
+)
+
+
+def _reverse_geocode_module():
+    # Imported lazily: reverse_geocode pulls in SciPy at import time
+    import reverse_geocode
+    return reverse_geocode
+
+
+def reverse_geocode(lat, lon):
+    """
+    Finds the closest known city to a point.
+
+    The city dataset and its KD-tree are built on the first call in each
+    process, unless preload() already built them in the master process.
+
+    :param lat: float, latitude of the point.
+    :param lon: float, longitude of the point.
+    :return: dict with keys such as 'city', 'country', 'country_code'.
+    """
+    return _reverse_geocode_module().get((lat, lon))
+
+
+def preload(freeze=True):
+    """
+    Imports the heavy dependencies and builds the geocoding index.
+
+    Meant to run in the master process before workers are forked, so that
+    every worker shares the same pages copy-on-write instead of building its
+    own copy. Must not open any database connection.
+
+    :param freeze: bool, move every object allocated so far to the permanent
+                   GC generation, so the collector never touches (and copies)
+                   the shared pages in the workers.
+    """
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    # GeocodeData is a singleton keyed by its arguments: build it exactly as
+    # reverse_geocode.get() does so every later lookup reuses this instance
+    _reverse_geocode_module().GeocodeData(0)
+    if freeze:
+        gc.collect()
+        gc.freeze()
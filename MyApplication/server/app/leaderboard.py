@@ -0,0 +1,84 @@
+import threading
+from itertools import islice
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """
+    In-memory order-statistic view of a leaderboard.
+
+    Scores are non-negative integers (measurement count, cities, cells).
+    Every user is kept in one sorted list of (-score, user) entries, so
+    updates and rank queries run in O(log n) and a top-N query only touches
+    the n entries it returns, however many users share a score.
+    Ties share the same rank (1 + number of users with a strictly higher score)
+    and are listed by username.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scores = {}  # user -> score
+        self._order = SortedList()  # (-score, user), best first
+
+    def __len__(self):
+        return len(self._scores)
+
+    def set_score(self, user, score):
+        """
+        Sets the score of a user, inserting the user if needed.
+
+        :param user: str, the username.
+        :param score: int, the new score.
+        """
+        score = max(int(score), 0)
+        with self._lock:
+            old = self._scores.get(user)
+            if old == score:
+                return
+            if old is not None:
+                self._order.remove((-old, user))
+            self._scores[user] = score
+            self._order.add((-score, user))
+
+    def load(self, entries):
+        """
+        Replaces the whole board with the given (user, score) pairs.
+        """
+        scores = {user: max(int(score), 0) for user, score in entries}
+        order = SortedList((-score, user) for user, score in scores.items())
+        with self._lock:
+            self._scores = scores
+            self._order = order
+
+    def get_score(self, user):
+        return self._scores.get(user)
+
+    def rank(self, user):
+        """
+        :param user: str, the username.
+        :return: dict with 'rank', 'score' and 'total', or None if the user is not ranked.
+        """
+        with self._lock:
+            score = self._scores.get(user)
+            if score is None:
+                return None
+            # '' sorts before every username, so this counts the strictly higher scores
+            higher = self._order.bisect_left((-score, ''))
+            return {'rank': higher + 1, 'score': score, 'total': len(self._order)}
+
+    def top(self, n):
+        """
+        :param n: int, the number of entries to return.
+        :return: list of dicts with 'rank', 'username' and 'score', best first.
+        """
+        result = []
+        with self._lock:
+            for position, (negative_score, user) in enumerate(islice(self._order, n)):
+                score = -negative_score
+                if result and result[-1]['score'] == score:
+                    rank = result[-1]['rank']
+                else:
+                    rank = position + 1
+                result.append({'rank': rank, 'username': user, 'score': score})
+        return result
@@ -1,18 +1,35 @@
-from app.extensions import mongo
+from app.extensions import mongo, router, aggregation_writer
 from app.models import User
 from bson import ObjectId
 from app.extensions import bcrypt
+from app.leaderboard import Leaderboard
+from app import geo
+from app.db import ROUTE_HEATMAP, ROUTE_PROFILE, ROUTE_LEADERBOARD, ROUTE_RAW_INSERT
+from app.utils import get_geohash_ranges_for_bbox
 import geohash2 as Geohash
-import reverse_geocode
-from datetime import datetime # Import datetime for explicit type handling
+import os
+import threading
+import time
+from datetime import datetime, timedelta # Import datetime for explicit type handling
 
-# from pymongo import ReturnDocument # This import is commented out in the original code, so we keep it that way.
+from pymongo import ReturnDocument
 
 # Achievement thresholds
 ACH_THRESHOLD_MEASUREMENTS = 5
 ACH_THRESHOLD_CITIES = 4
 ACH_THRESHOLD_COUNTRIES = 2
 
+# Leaderboards maintained at ingest
+LEADERBOARD_MEASUREMENTS = 'measurements'
+LEADERBOARD_CITIES = 'cities'
+LEADERBOARD_CELLS = 'cells'
+LEADERBOARDS = (LEADERBOARD_MEASUREMENTS, LEADERBOARD_CITIES, LEADERBOARD_CELLS)
+# How often (seconds) each worker applies the leaderboard changes made by the other workers
+LEADERBOARD_REFRESH_SECONDS = 30
+# Changes are re-read with this overlap (at least MONGO_MAX_STALENESS_S, as the
+# boards are read from secondaries), to catch writes that committed or replicated late
+LEADERBOARD_REFRESH_OVERLAP = timedelta(seconds=10)
+
 class UserRepository:
     @staticmethod
     def get_by_username(username):
@@ -62,26 +79,19 @@ class UserRepository:
         :return: int or None, the updated count or None if an error occurred.
         """
         try:
-            # Use return_document=ReturnDocument.AFTER to get the updated document
-            # However, ReturnDocument is commented out, so we will just increment
-            # and potentially retrieve the count separately if needed, or rely
-            # on the fact that find_one_and_update returns the document before update by default
-            # unless return_document is specified.
+            # ReturnDocument.AFTER returns the document with the count already incremented,
+            # so each concurrent call sees its own count and no second read is needed
             updated_user_doc = mongo.db.users.find_one_and_update(
                 {'username': username},
                 {'$inc': {'count': 1}},
-                # Uncomment the line below if you import ReturnDocument and want the document AFTER update
-                # return_document=ReturnDocument.AFTER
+                return_document=ReturnDocument.AFTER
             )
-            # If return_document=ReturnDocument.AFTER was used, you could return updated_user_doc['count']
-            # Since it's not used, we can't reliably get the *new* count from the return value directly
-            # unless we perform another query or change the logic to use return_document.
-            # For now, we'll just confirm the update happened. A subsequent call to get_user_measurement_count
-            # is needed to get the precise *new* count.
-            return updated_user_doc is not None # Return True if update was successful, False otherwise
+            if updated_user_doc is None:
+                return None
+            return updated_user_doc.get('count', 0)
         except Exception as e:
             print(f"Error incrementing count for user {username}: {e}")
-            return False # Indicate failure
+            return None # Indicate failure
 
 
     # Get the measurement count for a user
@@ -166,30 +176,23 @@ class MeasurementRepository:
 
         try:
             # --- Step 2: Insert the raw measurement
-            insert_result = mongo.db.raw_measurements.insert_one(raw_doc)
+            insert_result = router.collection('raw_measurements', ROUTE_RAW_INSERT).insert_one(raw_doc)
             raw_measurement_id = insert_result.inserted_id
 
             # --- Step 3: Upsert the aggregated measurement for the time bucket and geohash
-            # Use an atomic upsert to increment sum and count
-            mongo.db.aggregated_measurements.update_one(
-                { 'geohash': geohash, 'time_bucket': time_bucket },
+            # Increments sum and count atomically, or coalesces them in memory (see app/aggregation.py)
+            aggregation_writer.add(
+                geohash,
+                time_bucket,
+                noise_level,
+                # Saved as the cell center on the first insertion
                 {
-                    '$inc': {
-                        'sum_noise': noise_level,
-                        'count': 1
-                    },
-                    '$setOnInsert': {
-                        # Save the cell center on the first insertion
-                        'center': {
-                            'type': 'Point',
-                            'coordinates': [
-                                location['coordinates'][0], # longitude
-                                location['coordinates'][1]  # latitude
-                            ]
-                        }
-                    }
-                },
-                upsert=True
+                    'type': 'Point',
+                    'coordinates': [
+                        location['coordinates'][0], # longitude
+                        location['coordinates'][1]  # latitude
+                    ]
+                }
             )
 
         except Exception as e:
@@ -211,15 +214,15 @@ class MeasurementRepository:
         # --- Step 4: Check for achievements
 
         # Get location information using reverse geocoding
-        # reverse_geocode expects a list of (latitude, longitude) tuples
-        geo_info = reverse_geocode.get(location['coordinates'][::-1])
+        # The geocoding index is built lazily (or preloaded before fork, see app.geo)
+        geo_info = geo.reverse_geocode(location['coordinates'][1], location['coordinates'][0])
 
         # 4.1) Check for Measurement Count Achievement
         # Increment the user's total measurement count
-        increment_success = UserRepository.increment_measurement_count(user_id)
+        current_measurement_count = UserRepository.increment_measurement_count(user_id)
 
-        if increment_success:
-            current_measurement_count = UserRepository.get_user_measurement_count(user_id)
+        if current_measurement_count is not None:
+            LeaderboardRepository.update_score(LEADERBOARD_MEASUREMENTS, user_id, current_measurement_count)
             if current_measurement_count == ACH_THRESHOLD_MEASUREMENTS:
                 achievement_data = {
                     'title': 'Measurement Master',
@@ -259,6 +262,8 @@ class MeasurementRepository:
 
                 # Get the count of distinct cities visited by the user AFTER this measurement
                 new_city_count = mongo.db.user_cities.count_documents({ "user_id": user_id })
+                if new_city_count > old_city_count:
+                    LeaderboardRepository.update_score(LEADERBOARD_CITIES, user_id, new_city_count)
 
                 # Check if the new count crossed the threshold AND it was a new city visit that caused the count to increase
                 if new_city_count == ACH_THRESHOLD_CITIES and new_city_count > old_city_count:
@@ -318,6 +323,9 @@ class MeasurementRepository:
             print(f"Could not retrieve country name for location: {location}")
 
 
+        # 4.4) Track the distinct geohash cells covered by the user
+        LeaderboardRepository.record_cell(user_id, geohash)
+
         # Return the dictionary of earned achievements or True if no achievements were earned
         return earned_achievements if earned_achievements else True
 
@@ -404,8 +412,305 @@ class MeasurementRepository:
         pipeline.append(project_stage)
 
         # Execute the aggregation pipeline
-        return list(mongo.db.aggregated_measurements.aggregate(pipeline))
+        return list(router.collection('aggregated_measurements', ROUTE_HEATMAP).aggregate(pipeline))
+
+    @staticmethod
+    def get_aggregated_by_bbox(min_lat, min_lon, max_lat, max_lon, start_ts=None, end_ts=None):
+        """
+        Retrieve aggregated measurements inside a rectangle (the map viewport)
+        and optional time range, computing the average intensity on the fly.
+
+        The rectangle is covered by a few geohash prefix ranges, each served by
+        a range scan on the {geohash, time_bucket} index. Unlike
+        get_aggregated_by_geohash, results are not sorted by distance.
+
+        :param min_lat:  float, south edge of the rectangle
+        :param min_lon:  float, west edge (greater than max_lon if crossing the antimeridian)
+        :param max_lat:  float, north edge of the rectangle
+        :param max_lon:  float, east edge of the rectangle
+        :param start_ts: datetime, inclusive start of time range (optional)
+        :param end_ts:   datetime, inclusive end of time range (optional)
+        :return: List of dicts with keys 'geohash', 'lat', 'lon', 'intensity', 'count'
+        """
+        ranges = get_geohash_ranges_for_bbox(min_lat, min_lon, max_lat, max_lon)
+        if not ranges:
+            return []
+        geohash_query = []
+        for start, end in ranges:
+            bounds = {'$gte': start}
+            if end is not None:
+                bounds['$lt'] = end
+            geohash_query.append({'geohash': bounds})
+
+        match_query = {'$or': geohash_query} if len(geohash_query) > 1 else geohash_query[0]
+        if start_ts or end_ts:
+            time_bucket_query = {}
+            if start_ts:
+                time_bucket_query['$gte'] = start_ts.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+            if end_ts:
+                time_bucket_query['$lte'] = end_ts.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+            match_query['time_bucket'] = time_bucket_query
+
+        # Cells on the edge of the cover may lie slightly outside the rectangle
+        if min_lon <= max_lon:
+            lon_query = { 'lon': { '$gte': min_lon, '$lte': max_lon } }
+        else:
+            lon_query = { '$or': [ { 'lon': { '$gte': min_lon } }, { 'lon': { '$lte': max_lon } } ] }
+
+        pipeline = [
+            { '$match': match_query },
+            {
+                '$group': {
+                    '_id': '$geohash',
+                    'sum_noise': { '$sum': '$sum_noise' },
+                    'count':     { '$sum': '$count' },
+                    'center':    { '$first': '$center' }
+                }
+            },
+            {
+                '$project': {
+                    '_id':      0,
+                    'geohash':  '$_id',
+                    'lat':      { '$arrayElemAt': ['$center.coordinates', 1] },
+                    'lon':      { '$arrayElemAt': ['$center.coordinates', 0] },
+                    'count':    1,
+                    'intensity': {
+                        '$cond': [
+                            { '$gt': ['$count', 0] },
+                            { '$divide': ['$sum_noise', '$count'] },
+                            0
+                        ]
+                    }
+                }
+            },
+            { '$match': { 'lat': { '$gte': min_lat, '$lte': max_lat }, **lon_query } }
+        ]
+
+        return list(router.collection('aggregated_measurements', ROUTE_HEATMAP).aggregate(pipeline))
+
+    @staticmethod
+    def ensure_indexes():
+        # Used by get_aggregated_by_geohash ($geoNear)
+        mongo.db.aggregated_measurements.create_index([('center', '2dsphere')])
+        # Upsert key of AggregationWriter (hot cells may have one document per shard)
+        # and range scans of get_aggregated_by_bbox
+        mongo.db.aggregated_measurements.create_index([('geohash', 1), ('time_bucket', 1), ('shard', 1)], unique=True)
+
+
+
+class LeaderboardRepository:
+    """
+    Leaderboards are materialized in the 'leaderboards' collection
+    ({board, user_id, score, updated_at}) and updated incrementally by process_measurement.
+    Each worker loads an in-memory Leaderboard per board once, then a
+    background thread applies only the documents changed since the last sync
+    every LEADERBOARD_REFRESH_SECONDS. Rank and top-N queries never sort or
+    group over users, user_cities or raw_measurements, and never reload the board.
+    """
+    _boards = {}
+    _synced_until = {}  # board -> latest updated_at read, None while the board is empty
+    _lock = threading.Lock()
+    _refresher_pid = None
+
+    @staticmethod
+    def ensure_indexes():
+        mongo.db.leaderboards.create_index([('board', 1), ('user_id', 1)], unique=True)
+        mongo.db.leaderboards.create_index([('board', 1), ('score', -1)])
+        mongo.db.leaderboards.create_index([('board', 1), ('updated_at', 1)])
+        mongo.db.user_cells.create_index([('user_id', 1), ('geohash', 1)], unique=True)
+
+    @staticmethod
+    def _get_board(board):
+        """
+        Returns the in-memory board, loading it from the materialized collection on first use.
+        """
+        local = LeaderboardRepository._boards.get(board)
+        if local is not None:
+            return local
+        with LeaderboardRepository._lock:
+            if board not in LeaderboardRepository._boards:
+                # Synced up to the latest change actually read: the secondary
+                # may lag, so the app clock would skip changes not replicated yet
+                synced_until = None
+                local = Leaderboard()
+                cursor = router.collection('leaderboards', ROUTE_LEADERBOARD).find(
+                    {'board': board}, {'_id': 0, 'user_id': 1, 'score': 1, 'updated_at': 1}
+                )
+                entries = []
+                for doc in cursor:
+                    entries.append((doc['user_id'], doc['score']))
+                    synced_until = LeaderboardRepository._latest(synced_until, doc.get('updated_at'))
+                local.load(entries)
+                LeaderboardRepository._synced_until[board] = synced_until
+                LeaderboardRepository._boards[board] = local
+            LeaderboardRepository._ensure_refresher()
+        return LeaderboardRepository._boards[board]
+
+    @staticmethod
+    def _ensure_refresher():
+        # Started lazily, and again after a fork, as threads do not survive fork()
+        if LeaderboardRepository._refresher_pid != os.getpid():
+            LeaderboardRepository._refresher_pid = os.getpid()
+            threading.Thread(target=LeaderboardRepository._run_refresher, name='leaderboard-refresher', daemon=True).start()
+
+    @staticmethod
+    def _run_refresher():
+        while True:
+            time.sleep(LEADERBOARD_REFRESH_SECONDS)
+            try:
+                LeaderboardRepository.refresh()
+            except Exception as e:
+                print(f"Error refreshing leaderboards: {e}")
+
+    @staticmethod
+    def _latest(synced_until, updated_at):
+        if updated_at is None:
+            return synced_until
+        return updated_at if synced_until is None else max(synced_until, updated_at)
+
+    @staticmethod
+    def refresh():
+        """
+        Applies to the loaded boards the documents changed since their last sync.
+        """
+        overlap = max(LEADERBOARD_REFRESH_OVERLAP, timedelta(seconds=router.max_staleness_s))
+        for board in list(LeaderboardRepository._boards):
+            local = LeaderboardRepository._boards.get(board)
+            if local is None:
+                continue
+            synced_until = LeaderboardRepository._synced_until[board]
+            query = {'board': board}
+            if synced_until is not None:
+                query['updated_at'] = {'$gte': synced_until - overlap}
+            cursor = router.collection('leaderboards', ROUTE_LEADERBOARD).find(
+                query, {'_id': 0, 'user_id': 1, 'score': 1, 'updated_at': 1}
+            )
+            for doc in cursor:
+                local.set_score(doc['user_id'], doc['score'])
+                synced_until = LeaderboardRepository._latest(synced_until, doc.get('updated_at'))
+            LeaderboardRepository._synced_until[board] = synced_until
+
+    @staticmethod
+    def update_score(board, user_id, score):
+        """
+        Stores the new score of a user in the materialized leaderboard.
+
+        :param board: str, one of LEADERBOARDS.
+        :param user_id: str, the username.
+        :param score: int, the new score.
+        :return: bool, True if the update was stored, False otherwise.
+        """
+        try:
+            # $max keeps the board monotonic if concurrent requests land out of order
+            mongo.db.leaderboards.update_one(
+                {'board': board, 'user_id': user_id},
+                {'$max': {'score': score}, '$currentDate': {'updated_at': True}},
+                upsert=True
+            )
+            if board in LeaderboardRepository._boards:
+                local = LeaderboardRepository._boards[board]
+                local.set_score(user_id, max(score, local.get_score(user_id) or 0))
+            return True
+        except Exception as e:
+            print(f"Error updating leaderboard {board} for user {user_id}: {e}")
+            return False
+
+    @staticmethod
+    def increment_score(board, user_id, amount=1):
+        """
+        Increments the score of a user in the materialized leaderboard.
+
+        :return: int or None, the updated score or None if an error occurred.
+        """
+        try:
+            doc = mongo.db.leaderboards.find_one_and_update(
+                {'board': board, 'user_id': user_id},
+                {'$inc': {'score': amount}, '$currentDate': {'updated_at': True}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            if board in LeaderboardRepository._boards:
+                LeaderboardRepository._boards[board].set_score(user_id, doc['score'])
+            return doc['score']
+        except Exception as e:
+            print(f"Error incrementing leaderboard {board} for user {user_id}: {e}")
+            return None
 
+    @staticmethod
+    def record_cell(user_id, geohash):
+        """
+        Records that a user measured inside a geohash cell and bumps the
+        'cells' leaderboard the first time the cell is covered.
+        """
+        try:
+            result = mongo.db.user_cells.update_one(
+                {'user_id': user_id, 'geohash': geohash},
+                {'$setOnInsert': {'user_id': user_id, 'geohash': geohash}},
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                LeaderboardRepository.increment_score(LEADERBOARD_CELLS, user_id)
+        except Exception as e:
+            print(f"Error recording cell {geohash} for user {user_id}: {e}")
+
+    @staticmethod
+    def get_top(board, limit=10):
+        """
+        :param board: str, one of LEADERBOARDS.
+        :param limit: int, the number of entries to return.
+        :return: list of dicts with keys 'rank', 'username', 'score'.
+        """
+        return LeaderboardRepository._get_board(board).top(limit)
+
+    @staticmethod
+    def get_rank(board, user_id):
+        """
+        :param board: str, one of LEADERBOARDS.
+        :param user_id: str, the username.
+        :return: dict with keys 'rank', 'score', 'total', or None if the user is not ranked.
+        """
+        return LeaderboardRepository._get_board(board).rank(user_id)
+
+    @staticmethod
+    def rebuild():
+        """
+        Recomputes every materialized leaderboard from scratch.
+        Only needed once to backfill data collected before the leaderboards existed.
+        """
+        LeaderboardRepository.ensure_indexes()
+        sources = {
+            LEADERBOARD_MEASUREMENTS: (
+                (doc['username'], doc.get('count', 0))
+                for doc in mongo.db.users.find({}, {'username': 1, 'count': 1})
+            ),
+            LEADERBOARD_CITIES: (
+                (doc['_id'], doc['score'])
+                for doc in mongo.db.user_cities.aggregate([
+                    { '$group': { '_id': '$user_id', 'score': { '$sum': 1 } } }
+                ])
+            ),
+        }
+        # Backfill the distinct cells covered from the raw measurements
+        for doc in mongo.db.raw_measurements.aggregate([
+            { '$group': { '_id': { 'user_id': '$user_id', 'geohash': '$geohash' } } }
+        ]):
+            mongo.db.user_cells.update_one(doc['_id'], {'$setOnInsert': doc['_id']}, upsert=True)
+        sources[LEADERBOARD_CELLS] = (
+            (doc['_id'], doc['score'])
+            for doc in mongo.db.user_cells.aggregate([
+                { '$group': { '_id': '$user_id', 'score': { '$sum': 1 } } }
+            ])
+        )
+
+        for board, entries in sources.items():
+            for user_id, score in entries:
+                mongo.db.leaderboards.update_one(
+                    {'board': board, 'user_id': user_id},
+                    {'$set': {'score': score}, '$currentDate': {'updated_at': True}},
+                    upsert=True
+                )
+            # Reloaded in full on the next request
+            LeaderboardRepository._boards.pop(board, None)
 
 
 class RawMeasurementRepository:
@@ -436,7 +741,7 @@ class RawMeasurementRepository:
             # 'duration': duration, # Uncomment and pass duration if needed
         }
         # Insert the document and return the inserted ID
-        result = mongo.db.raw_measurements.insert_one(measurement)
+        result = router.collection('raw_measurements', ROUTE_RAW_INSERT).insert_one(measurement)
         return result.inserted_id
 
     @staticmethod
@@ -465,7 +770,7 @@ class RawMeasurementRepository:
             { '$group': { '_id': None, 'total_duration': { '$sum': '$duration' } } }
         ]
 
-        result = list(mongo.db.raw_measurements.aggregate(pipeline))
+        result = list(router.collection('raw_measurements', ROUTE_PROFILE).aggregate(pipeline))
 
         # Return the total duration if results are found, otherwise 0
         return result[0]['total_duration'] if result else 0
@@ -497,7 +802,7 @@ class RawMeasurementRepository:
             { '$group': { '_id': None, 'total_duration': { '$sum': '$duration' } } }
         ]
 
-        result = list(mongo.db.raw_measurements.aggregate(pipeline))
+        result = list(router.collection('raw_measurements', ROUTE_PROFILE).aggregate(pipeline))
 
         # Return the total duration if results are found, otherwise 0
         return result[0]['total_duration'] if result else 0
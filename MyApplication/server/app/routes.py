@@ -1,7 +1,10 @@
-from flask import Blueprint, redirect, request, jsonify, url_for
+import hmac
+
+from flask import Blueprint, current_app, redirect, request, jsonify, url_for
 from flask_login import login_required, login_user, logout_user, current_user
-from app.repository import UserRepository, MeasurementRepository, RawMeasurementRepository
-from app.extensions import login_manager
+from app.repository import UserRepository, MeasurementRepository, RawMeasurementRepository, LeaderboardRepository, LEADERBOARDS
+from app.extensions import login_manager, admission, router, aggregation_writer
+from app.admission import INGEST, READ
 from datetime import datetime
 from app.utils import get_geohashes_within_radius
 from logging import log
@@ -91,6 +94,7 @@ def profile():
 
 @bp.route('/measurements', methods=['POST'])
 @login_required
+@admission.limit(INGEST)
 def add_measurement():
     try:
         data = request.get_json()
@@ -135,6 +139,7 @@ def add_measurement():
 
 @bp.route('/measurements', methods=['GET'])
 @login_required
+@admission.limit(READ)
 def get_measurements():
     try:
         latitude = request.args.get('latitude', type=float)
@@ -143,12 +148,23 @@ def get_measurements():
         start_ts_str = request.args.get('start_timestamp')
         end_ts_str   = request.args.get('end_timestamp')
 
-        if latitude is None or longitude is None or radius_km is None:
-            return jsonify({"error": "Missing required query parameters"}), 400
-        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
-            return jsonify({"error": "Invalid coordinates"}), 400
-        if radius_km <= 0:
-            return jsonify({"error": "Radius must be > 0"}), 400
+        # Viewport mode: min_lat, min_lon, max_lat, max_lon instead of center + radius
+        bbox = [request.args.get(name, type=float) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+        use_bbox = any(value is not None for value in bbox)
+
+        if use_bbox:
+            if any(value is None for value in bbox):
+                return jsonify({"error": "Missing required query parameters"}), 400
+            min_lat, min_lon, max_lat, max_lon = bbox
+            if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+                return jsonify({"error": "Invalid bounding box"}), 400
+        else:
+            if latitude is None or longitude is None or radius_km is None:
+                return jsonify({"error": "Missing required query parameters"}), 400
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                return jsonify({"error": "Invalid coordinates"}), 400
+            if radius_km <= 0:
+                return jsonify({"error": "Radius must be > 0"}), 400
 
         # 3) Parse optional timestamps
         start_ts = None
@@ -165,13 +181,23 @@ def get_measurements():
                 return jsonify({"error": "Invalid end_timestamp format"}), 400
 
         # 4) Fetch aggregated measurements by geohash
-        measurements = MeasurementRepository.get_aggregated_by_geohash(
-            lat=latitude,
-            lon=longitude,
-            radius_km=radius_km,
-            start_ts=start_ts,
-            end_ts=end_ts
-        )
+        if use_bbox:
+            measurements = MeasurementRepository.get_aggregated_by_bbox(
+                min_lat=min_lat,
+                min_lon=min_lon,
+                max_lat=max_lat,
+                max_lon=max_lon,
+                start_ts=start_ts,
+                end_ts=end_ts
+            )
+        else:
+            measurements = MeasurementRepository.get_aggregated_by_geohash(
+                lat=latitude,
+                lon=longitude,
+                radius_km=radius_km,
+                start_ts=start_ts,
+                end_ts=end_ts
+            )
 
         # 5) Return JSON
         return jsonify(measurements), 200
@@ -179,3 +205,59 @@ def get_measurements():
     except Exception as e:
         # Log the error server‐side as needed
         return jsonify({"error": "Server error", "details": str(e)}), 500
+
+
+@bp.route('/leaderboard/<board>', methods=['GET'])
+@login_required
+def get_leaderboard(board):
+    """
+    Returns the top N users of a leaderboard ('measurements', 'cities' or 'cells').
+    """
+    if board not in LEADERBOARDS:
+        return jsonify({"error": "Unknown leaderboard"}), 404
+    limit = request.args.get('limit', type=int, default=10)
+    if limit <= 0 or limit > 100:
+        return jsonify({"error": "Limit must be between 1 and 100"}), 400
+    try:
+        return jsonify(LeaderboardRepository.get_top(board, limit)), 200
+    except Exception as e:
+        return jsonify({"error": "Server error", "details": str(e)}), 500
+
+
+@bp.route('/leaderboard/<board>/me', methods=['GET'])
+@login_required
+def get_my_rank(board):
+    """
+    Returns the rank of the current user in a leaderboard.
+    """
+    if board not in LEADERBOARDS:
+        return jsonify({"error": "Unknown leaderboard"}), 404
+    try:
+        rank = LeaderboardRepository.get_rank(board, current_user.username)
+        if rank is None:
+            return jsonify({"error": "User not ranked"}), 404
+        rank['username'] = current_user.username
+        return jsonify(rank), 200
+    except Exception as e:
+        return jsonify({"error": "Server error", "details": str(e)}), 500
+
+
+@bp.route('/stats', methods=['GET'])
+def stats():
+    """
+    Returns the Mongo pool and routing counters and the admission control state, for monitoring.
+    Only served to callers sending the STATS_TOKEN in the X-Stats-Token header: any user can
+    register, so a login is not enough. Without a configured token the endpoint does not exist.
+    """
+    token = current_app.config.get('STATS_TOKEN', '')
+    given = request.headers.get('X-Stats-Token', '')
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({
+        'mongo': router.stats(),
+        'admission': {
+            'mongo_latency_ms': admission.latency.latency_ms,
+            'shed': admission.shed
+        },
+        'aggregation': aggregation_writer.stats
+    }), 200
@@ -1,8 +1,10 @@
-from geopy.distance import geodesic
 import geohash2 as geohash
-import numpy as np
 
 def get_geohashes_within_radius(lat, lon, radius_km, precision=7):
+    # Imported lazily: geopy and NumPy are not needed to serve most requests
+    from geopy.distance import geodesic
+    import numpy as np
+
     # Calculate the bounding box for the geohashes
     lat_delta = radius_km / 111  # Approximately 111 km per degree of latitude
     lon_delta = radius_km / (111 * np.cos(np.radians(lat)))  # Correction for longitude
@@ -33,3 +35,104 @@ def get_geohashes_within_radius(lat, lon, radius_km, precision=7):
         lat_iter += lat_step
 
     return list(geohashes)
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def _geohash_cell_size(precision):
+    """Returns (height, width) in degrees of a geohash cell at a given precision."""
+    bits = 5 * precision
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def _geohashes_covering_bbox(min_lat, min_lon, max_lat, max_lon, precision):
+    height, width = _geohash_cell_size(precision)
+    geohashes = set()
+    # Walk the centers of the grid cells intersecting the rectangle, starting
+    # from the cell geohash puts the corner in: a point on a cell edge belongs
+    # to the lower cell, a point on the pole or the antimeridian to the last one
+    start_lat, start_lon, _, _ = geohash.decode_exactly(geohash.encode(min_lat, min_lon, precision=precision))
+    lat = start_lat
+    while lat - height / 2 <= max_lat and lat < 90:
+        lon = start_lon
+        while lon - width / 2 <= max_lon and lon < 180:
+            geohashes.add(geohash.encode(lat, lon, precision=precision))
+            lon += width
+        lat += height
+    return geohashes
+
+
+def _geohash_successor(prefix):
+    """Returns the first geohash prefix of the same length sorting after every child of prefix."""
+    while prefix:
+        index = GEOHASH_BASE32.index(prefix[-1])
+        if index < len(GEOHASH_BASE32) - 1:
+            return prefix[:-1] + GEOHASH_BASE32[index + 1]
+        prefix = prefix[:-1]
+    return None
+
+
+def _geohash_ranges_for_cells(cells):
+    # Merge complete groups of 32 siblings into their parent
+    cells = set(cells)
+    merged = True
+    while merged:
+        merged = False
+        parents = {}
+        for cell in cells:
+            if cell:
+                parents.setdefault(cell[:-1], []).append(cell)
+        for parent, children in parents.items():
+            if len(children) == len(GEOHASH_BASE32):
+                cells -= set(children)
+                cells.add(parent)
+                merged = True
+    return merge_geohash_ranges([(cell, _geohash_successor(cell)) for cell in cells])
+
+
+def get_geohash_ranges_for_bbox(min_lat, min_lon, max_lat, max_lon, max_precision=7, max_ranges=16, max_cells=256):
+    """
+    Covers a rectangle with geohash prefixes and turns them into the minimal
+    list of [start, end) ranges over the sorted geohash strings, so that each
+    range can be served by one index range scan on the 'geohash' field.
+
+    The finest precision (up to max_precision) whose cover fits in max_ranges
+    ranges is used: sibling cells that are all present are merged into their
+    parent and consecutive prefixes into a single range. max_cells bounds the
+    work spent enumerating a cover.
+    A rectangle crossing the antimeridian (min_lon > max_lon) is split in two.
+
+    :return: List of (start, end) tuples; end is None for the open-ended last range.
+    """
+    if min_lon > max_lon:
+        return merge_geohash_ranges(
+            get_geohash_ranges_for_bbox(min_lat, min_lon, max_lat, 180, max_precision, max_ranges // 2, max_cells // 2)
+            + get_geohash_ranges_for_bbox(min_lat, -180, max_lat, max_lon, max_precision, max_ranges // 2, max_cells // 2)
+        )
+
+    ranges = [('', None)]
+    for precision in range(1, max_precision + 1):
+        height, width = _geohash_cell_size(precision)
+        if ((max_lat - min_lat) / height + 2) * ((max_lon - min_lon) / width + 2) > max_cells:
+            break
+        cover = _geohash_ranges_for_cells(_geohashes_covering_bbox(min_lat, min_lon, max_lat, max_lon, precision))
+        if len(cover) > max_ranges:
+            break
+        ranges = cover
+    return ranges
+
+
+def merge_geohash_ranges(ranges):
+    """Merges overlapping or touching [start, end) ranges."""
+    merged = []
+    # Sorted by start only: end is None (open-ended) on the last range
+    for start, end in sorted(ranges, key=lambda r: r[0]):
+        if merged and (merged[-1][1] is None or merged[-1][1] >= start):
+            if merged[-1][1] is not None and (end is None or end > merged[-1][1]):
+                merged[-1] = (merged[-1][0], end)
+            continue
+        merged.append((start, end))
+    return merged
@@ -0,0 +1,112 @@
+"""
+Viewport query benchmark: geohash prefix range scans vs the $geoNear pipeline.
+
+Seeds a throw-away database with dense city data (every precision-7 cell of
+an area around Pisa, one document per hourly bucket), then times
+MeasurementRepository.get_aggregated_by_bbox against
+get_aggregated_by_geohash on the circle enclosing the same viewport.
+
+Requires a reachable MongoDB; the database is dropped at the end.
+
+Usage: MONGO_URI=mongodb://localhost:27017 python benchmarks/bbox_query.py [--hours 24]
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import geohash2 as Geohash
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.extensions import mongo  # noqa: E402
+from app.repository import MeasurementRepository  # noqa: E402
+from app.utils import _geohash_cell_size  # noqa: E402
+
+CITY = (43.60, 10.30, 43.80, 10.55)  # min_lat, min_lon, max_lat, max_lon
+PRECISION = 7
+VIEWPORTS = {
+    'street': (43.715, 10.400, 43.720, 10.410),
+    'district': (43.700, 10.380, 43.730, 10.430),
+    'city': (43.650, 10.340, 43.760, 10.500),
+}
+
+
+def seed(db, hours):
+    start = datetime(2025, 5, 1)
+    docs = []
+    # Step exactly one cell at a time from the center of the corner cell, so
+    # each geohash is seeded once (the unique index rejects duplicates)
+    height, width = _geohash_cell_size(PRECISION)
+    first_lat, first_lon, _, _ = Geohash.decode_exactly(Geohash.encode(CITY[0], CITY[1], precision=PRECISION))
+    lat = first_lat
+    while lat < CITY[2]:
+        lon = first_lon
+        while lon < CITY[3]:
+            gh = Geohash.encode(lat, lon, precision=PRECISION)
+            for hour in range(hours):
+                count = random.randint(1, 20)
+                docs.append({
+                    'geohash': gh,
+                    'time_bucket': start + timedelta(hours=hour),
+                    'sum_noise': count * random.uniform(35, 90),
+                    'count': count,
+                    'center': {'type': 'Point', 'coordinates': [lon, lat]},
+                })
+            if len(docs) >= 10000:
+                db.aggregated_measurements.insert_many(docs)
+                docs = []
+            lon += width
+        lat += height
+    if docs:
+        db.aggregated_measurements.insert_many(docs)
+    MeasurementRepository.ensure_indexes()
+    return start
+
+
+def timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t) * 1000)
+    samples.sort()
+    return len(result), statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    mongo.cx = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017'))
+    mongo.db = mongo.cx['noisecity_bbox_bench']
+    mongo.cx.drop_database('noisecity_bbox_bench')
+    try:
+        start = seed(mongo.db, args.hours)
+        print(f"seeded {mongo.db.aggregated_measurements.estimated_document_count()} documents")
+        # Query a 6-hour window, as the map does
+        start_ts, end_ts = start + timedelta(hours=6), start + timedelta(hours=11)
+        for name, (min_lat, min_lon, max_lat, max_lon) in VIEWPORTS.items():
+            center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+            half_h = (max_lat - min_lat) / 2 * 111
+            half_w = (max_lon - min_lon) / 2 * 111 * math.cos(math.radians(center_lat))
+            radius_km = math.hypot(half_h, half_w)
+
+            bbox = timed(lambda: MeasurementRepository.get_aggregated_by_bbox(
+                min_lat, min_lon, max_lat, max_lon, start_ts, end_ts), args.runs)
+            near = timed(lambda: MeasurementRepository.get_aggregated_by_geohash(
+                center_lat, center_lon, radius_km, start_ts, end_ts), args.runs)
+            print(f"{name:>8} | bbox    {bbox[0]:6d} cells  p50 {bbox[1]:8.2f} ms  p95 {bbox[2]:8.2f} ms")
+            print(f"{'':>8} | geoNear {near[0]:6d} cells  p50 {near[1]:8.2f} ms  p95 {near[2]:8.2f} ms")
+    finally:
+        mongo.cx.drop_database('noisecity_bbox_bench')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Startup-time and RSS-per-worker benchmark for the geocoding preload.
+
+Forks N workers the same way gunicorn does and, in each worker, times the
+first reverse geocoding lookup (what the first POST /measurements pays).
+Memory is read from /proc/<pid>/smaps_rollup (Linux only):
+  - rss:     resident memory of the worker
+  - pss:     proportional share, shared pages divided among the processes
+  - private: pages only this worker owns (what each extra worker really costs)
+
+Usage: python benchmarks/startup.py [--workers 4]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def smaps_rollup(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'private': values['Private_Clean'] + values['Private_Dirty'],
+    }
+
+
+def run_mode(mode, workers):
+    """Runs in a fresh interpreter so no module is already imported."""
+    sys.path.insert(0, SERVER_DIR)
+    from app import geo
+
+    started = time.perf_counter()
+    if mode == 'preload':
+        geo.preload()
+    master_s = time.perf_counter() - started
+
+    children = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            t = time.perf_counter()
+            geo.reverse_geocode(43.7228, 10.4017)
+            os.write(write_fd, f'{time.perf_counter() - t:.6f}'.encode())
+            os.close(write_fd)
+            time.sleep(3600)
+            os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+
+    first_lookup = []
+    for pid, read_fd in children:
+        first_lookup.append(float(os.read(read_fd, 64).decode()))
+        os.close(read_fd)
+    memory = [smaps_rollup(pid) for pid, _ in children]
+    for pid, _ in children:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+
+    avg = lambda key: sum(m[key] for m in memory) / len(memory) / 1024
+    print(f"{mode:>8} | master {master_s:6.2f}s | first lookup avg {sum(first_lookup) / len(first_lookup) * 1000:8.1f} ms"
+          f" | per worker rss {avg('rss'):6.1f} MiB, pss {avg('pss'):6.1f} MiB, private {avg('private'):6.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', choices=('lazy', 'preload'))
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.workers)
+        return
+    for mode in ('lazy', 'preload'):
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--workers', str(args.workers)], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Gunicorn configuration: gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Threaded workers serve several requests at once, so the admission control
+# concurrency limits (ADMISSION_*_CONCURRENCY) can actually fill up
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+# The app itself is NOT preloaded: PyMongo clients must be created after fork.
+# Only the read-only geocoding index and heavy imports are loaded in the master.
+preload_geo = os.getenv('PRELOAD_GEO', '1') == '1'
+
+
+def on_starting(server):
+    if preload_geo:
+        from app.geo import preload
+        preload()
+        server.log.info("Geocoding index preloaded and frozen before fork")
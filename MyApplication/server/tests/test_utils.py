@@ -0,0 +1,57 @@
+import random
+
+import geohash2 as geohash
+import pytest
+
+from app.utils import get_geohash_ranges_for_bbox, merge_geohash_ranges
+
+
+def _covered(ranges, code):
+    return any(start <= code and (end is None or code < end) for start, end in ranges)
+
+
+def _points(min_lat, min_lon, max_lat, max_lon, rng, count=200):
+    lon_span = (max_lon - min_lon) % 360 if min_lon > max_lon else max_lon - min_lon
+    # The corners and edge midpoints, then random points inside
+    points = [
+        (lat, lon)
+        for lat in (min_lat, (min_lat + max_lat) / 2, max_lat)
+        for lon in (min_lon, min_lon + lon_span / 2, min_lon + lon_span)
+    ]
+    points += [(rng.uniform(min_lat, max_lat), min_lon + rng.uniform(0, lon_span)) for _ in range(count)]
+    # Longitudes past the antimeridian wrap around
+    return [(lat, (lon + 180) % 360 - 180 if lon > 180 else lon) for lat, lon in points]
+
+
+def _assert_cover(min_lat, min_lon, max_lat, max_lon, rng):
+    ranges = get_geohash_ranges_for_bbox(min_lat, min_lon, max_lat, max_lon)
+    for lat, lon in _points(min_lat, min_lon, max_lat, max_lon, rng):
+        code = geohash.encode(lat, lon, precision=7)
+        assert _covered(ranges, code), (min_lat, min_lon, max_lat, max_lon, lat, lon, code)
+
+
+@pytest.mark.parametrize('bbox', [
+    (43.70, 10.38, 43.73, 10.42),      # a city viewport
+    (45.0, 10.0, 45.01, 10.01),        # corner on a cell edge
+    (38.7, 33.7, 55.6, 14.4),          # wide viewport crossing the antimeridian
+    (-10.0, 170.0, 10.0, -170.0),      # small viewport crossing the antimeridian
+    (89.9, -180.0, 90.0, 180.0),       # north pole
+    (-90.0, -10.0, -89.9, 10.0),       # south pole
+    (10.0, 180.0, 10.0, 180.0),        # flat box on the antimeridian
+    (-90.0, -180.0, 90.0, 180.0),      # the whole world
+])
+def test_bbox_cover_contains_every_point(bbox):
+    _assert_cover(*bbox, random.Random(0))
+
+
+def test_random_bbox_cover_contains_every_point():
+    rng = random.Random(42)
+    for _ in range(300):
+        lat_a, lat_b = sorted((rng.uniform(-90, 90), rng.uniform(-90, 90)))
+        min_lon, max_lon = rng.uniform(-180, 180), rng.uniform(-180, 180)
+        _assert_cover(lat_a, min_lon, lat_b, max_lon, rng)
+
+
+def test_merge_geohash_ranges_open_ended():
+    assert merge_geohash_ranges([('u', None), ('b', 'c'), ('c', 'd'), ('u', 'v')]) == [('b', 'd'), ('u', None)]
+    assert merge_geohash_ranges([('t', 'v'), ('u', None)]) == [('t', None)]
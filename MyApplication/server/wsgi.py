@@ -0,0 +1,7 @@
+import os
+import runpy
+
+# The 'app' package shadows app.py, so load create_app from the file directly
+create_app = runpy.run_path(os.path.join(os.path.dirname(__file__), 'app.py'))['create_app']
+
+app = create_app()